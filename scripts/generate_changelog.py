@@ -2,20 +2,30 @@
 """Generate changelogs from git commit history."""
 
 import argparse
+import io
 import os
 import re
+import shutil
 import subprocess
 import sys
 from collections import defaultdict
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
 
 # Delimiters for parsing git log output
-# Use git's %x00/%x01 escapes in format strings to avoid embedding literal
-# null bytes in subprocess arguments (which crashes Python 3.14+).
-FIELD_SEP = "\x00"
-RECORD_SEP = "\x01"
+# Use git's %x00 escape in format strings to avoid embedding literal null
+# bytes in subprocess arguments (which crashes Python 3.14+). With `git log -z`
+# records are NUL-terminated too, so every field ends in FIELD_SEP and records
+# are recovered by counting fields rather than by a second separator.
+# git output is read as bytes and only the extracted fields are decoded.
+FIELD_SEP = b"\x00"
 GIT_FIELD_SEP = "%x00"
-GIT_RECORD_SEP = "%x01"
+LOG_FIELDS = ["%H", "%s", "%an", "%ai"]
 
 CONVENTIONAL_MAP = {
     "feat": "Added",
@@ -48,125 +58,273 @@ CATEGORY_ORDER = [
     "Other",
 ]
 
+CATEGORY_INDEX = {name: i for i, name in enumerate(CATEGORY_ORDER)}
+
+# Compiled once and reused for every commit; match it via _classify only.
 CONV_PATTERN = re.compile(
     r"^(?P<type>\w+)(?:\((?P<scope>[^)]*)\))?(?P<bang>!)?:\s*(?P<desc>.+)$"
 )
 
+# Leading H1 of an existing changelog, allowing a BOM and blank lines before it.
+_H1_RE = re.compile(rb"\A(?:\xef\xbb\xbf)?(?:[ \t]*\r?\n)*# .+\n")
+
 
 def run_git(*args):
-    result = subprocess.run(["git"] + list(args), capture_output=True, text=True)
+    result = subprocess.run(["git"] + list(args), capture_output=True)
     if result.returncode != 0:
         return None
     return result.stdout.strip()
 
 
+def _decode(raw):
+    return raw.decode("utf-8", errors="replace")
+
+
+@lru_cache(maxsize=1)
 def get_latest_tag():
-    return run_git("describe", "--tags", "--abbrev=0")
+    out = run_git("describe", "--tags", "--abbrev=0")
+    if out:
+        return _decode(out)
+    return None
 
 
+@lru_cache(maxsize=1)
 def get_first_commit():
     out = run_git("rev-list", "--max-parents=0", "HEAD")
     if out:
-        return out.splitlines()[0]
+        return _decode(out.splitlines()[0])
     return None
 
 
-def get_commits(from_ref, to_ref, no_merges=False):
-    fmt = GIT_FIELD_SEP.join(["%H", "%s", "%an", "%ai", f"%b{GIT_RECORD_SEP}"])
-    args = ["log", f"{from_ref}..{to_ref}", f"--pretty=format:{fmt}"]
+def clear_cache():
+    """Forget cached ref lookups, e.g. after the repository has changed."""
+    get_latest_tag.cache_clear()
+    get_first_commit.cache_clear()
+
+
+def get_breaking_bodies(from_ref, to_ref, no_merges=False):
+    """Map full hashes to bodies for the commits that mention BREAKING CHANGE."""
+    args = [
+        "log",
+        "-z",
+        f"{from_ref}..{to_ref}",
+        "--grep=BREAKING CHANGE",
+        f"--pretty=tformat:%H{GIT_FIELD_SEP}%b",
+    ]
     if no_merges:
         args.append("--no-merges")
     output = run_git(*args)
     if not output:
-        return []
-    commits = []
-    for record in output.split(RECORD_SEP):
-        record = record.strip()
-        if not record:
+        return {}
+    fields = output.split(FIELD_SEP)
+    return {
+        full_hash.decode("ascii"): _decode(body.strip())
+        for full_hash, body in zip(fields[0::2], fields[1::2])
+    }
+
+
+def iter_git_log(from_ref, to_ref, no_merges=False):
+    """Yield commit dicts as git streams them instead of buffering the whole log."""
+    # Bodies are only consulted for the BREAKING CHANGE footer, so fetch them
+    # for the matching commits alone rather than piping every body through.
+    bodies = get_breaking_bodies(from_ref, to_ref, no_merges)
+    fmt = GIT_FIELD_SEP.join(LOG_FIELDS)
+    args = ["git", "log", "-z", f"{from_ref}..{to_ref}", f"--pretty=tformat:{fmt}"]
+    if no_merges:
+        args.append("--no-merges")
+    proc = subprocess.Popen(
+        args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1024 * 1024
+    )
+    n = len(LOG_FIELDS)
+    fields = []
+    tail = b""
+    try:
+        while chunk := proc.stdout.read(65536):
+            *complete, tail = (tail + chunk).split(FIELD_SEP)
+            fields.extend(complete)
+            end = len(fields) - len(fields) % n
+            for i in range(0, end, n):
+                yield _parse_record(fields[i : i + n], bodies)
+            del fields[:end]
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def _parse_record(fields, bodies):
+    hash_part, subject, author, date = fields
+    full_hash = hash_part.decode("ascii")
+    return {
+        "hash": full_hash[:8],
+        "subject": _decode(subject),
+        "author": _decode(author),
+        "date": date[:10].decode("ascii"),
+        "body": bodies.get(full_hash, ""),
+    }
+
+
+def open_repo(path="."):
+    """Open the enclosing repository with pygit2, or return None if unavailable."""
+    if pygit2 is None:
+        return None
+    found = pygit2.discover_repository(path)
+    if not found:
+        return None
+    return pygit2.Repository(found)
+
+
+def iter_commits_pygit2(repo, from_ref, to_ref, no_merges=False):
+    """Yield the same commit dicts as iter_git_log by walking the repo in-process."""
+    try:
+        to_oid = repo.revparse_single(to_ref).peel(pygit2.Commit).id
+        from_oid = repo.revparse_single(from_ref).peel(pygit2.Commit).id
+    except (KeyError, ValueError, pygit2.GitError):
+        return
+    walker = repo.walk(to_oid, pygit2.GIT_SORT_TIME)
+    walker.hide(from_oid)
+    for c in walker:
+        if no_merges and len(c.parent_ids) > 1:
             continue
-        parts = record.split(FIELD_SEP, 4)
-        if len(parts) == 5:
-            commits.append(
-                {
-                    "hash": parts[0][:8],
-                    "subject": parts[1],
-                    "author": parts[2],
-                    "date": parts[3][:10],
-                    "body": parts[4].strip(),
-                }
-            )
-    return commits
+        # Like git's %s, the subject is the whole first paragraph on one line.
+        head, _, body = c.message.strip().partition("\n\n")
+        subject = " ".join(head.split("\n"))
+        tz = timezone(timedelta(minutes=c.author.offset))
+        yield {
+            "hash": str(c.id)[:8],
+            "subject": subject,
+            "author": c.author.name,
+            "date": datetime.fromtimestamp(c.author.time, tz).strftime("%Y-%m-%d"),
+            "body": body.strip(),
+        }
+
+
+def iter_commits(from_ref, to_ref, no_merges=False, repo=None):
+    """Yield commits in range, in-process via pygit2 when present, else via git log."""
+    if repo is None:
+        repo = open_repo()
+    if repo is not None:
+        return iter_commits_pygit2(repo, from_ref, to_ref, no_merges)
+    return iter_git_log(from_ref, to_ref, no_merges)
+
+
+def iter_log_ranges(ranges, no_merges=False):
+    """Yield ``(from_ref, to_ref, commits)`` for each range, opening the repo once."""
+    repo = open_repo()
+    for from_ref, to_ref in ranges:
+        yield from_ref, to_ref, list(iter_commits(from_ref, to_ref, no_merges, repo))
+
+
+def _classify(subject, body):
+    """Match a subject once, returning ``(match, category, scope, description)``."""
+    m = CONV_PATTERN.match(subject)
+    if not m:
+        return None, "Other", "", subject
+    desc = m.group("desc")
+    category = CONVENTIONAL_MAP.get(m.group("type"), "Other")
+    # The footer only counts at the start of a body line; a description that
+    # opens with the token is kept for older, non-spec commit styles.
+    if (
+        m.group("bang")
+        or desc.startswith("BREAKING CHANGE")
+        or body.startswith("BREAKING CHANGE")
+        or "\nBREAKING CHANGE" in body
+    ):
+        category = "Breaking Changes"
+    return m, category, m.group("scope") or "", desc
 
 
 def parse_commit(commit):
-    subject = commit["subject"]
-    body = commit.get("body", "")
-    m = CONV_PATTERN.match(subject)
-    if m:
-        ctype = m.group("type")
-        scope = m.group("scope") or ""
-        bang = m.group("bang")
-        desc = m.group("desc")
-        category = CONVENTIONAL_MAP.get(ctype, "Other")
-        if bang or "BREAKING CHANGE" in subject or "BREAKING CHANGE" in body:
-            category = "Breaking Changes"
-        return {**commit, "category": category, "scope": scope, "description": desc}
-    return {**commit, "category": "Other", "scope": "", "description": subject}
+    conv = commit.get("_conv") or _classify(commit["subject"], commit.get("body", ""))
+    _, category, scope, desc = conv
+    parsed = {k: v for k, v in commit.items() if k != "_conv"}
+    parsed.update(category=category, scope=scope, description=desc)
+    return parsed
 
 
 def group_commits(commits):
-    grouped = defaultdict(list)
+    """Return one list of parsed commits per CATEGORY_ORDER entry, by index."""
+    buckets = [[] for _ in CATEGORY_ORDER]
     for c in commits:
         parsed = parse_commit(c)
-        grouped[parsed["category"]].append(parsed)
-    return grouped
-
-
-def format_keepachangelog(commits, from_ref, to_ref):
-    grouped = group_commits(commits)
-    today = datetime.now().strftime("%Y-%m-%d")
-    lines = [f"## [{to_ref}] - {today}\n"]
-
-    for cat in CATEGORY_ORDER:
-        if cat in grouped:
-            lines.append(f"### {cat}\n")
-            for c in grouped[cat]:
-                scope = f"**{c['scope']}**: " if c["scope"] else ""
-                lines.append(f"- {scope}{c['description']} ({c['hash']})")
-            lines.append("")
-
-    return "\n".join(lines)
-
-
-def format_conventional(commits, from_ref, to_ref):
-    grouped = group_commits(commits)
-    today = datetime.now().strftime("%Y-%m-%d")
-    lines = [f"# {to_ref} ({today})\n"]
+        buckets[CATEGORY_INDEX[parsed["category"]]].append(parsed)
+    return buckets
+
+
+def format_keepachangelog(
+    commits, from_ref, to_ref, grouped=None, today=None, out=None
+):
+    if grouped is None:
+        grouped = group_commits(commits)
+    today = today or date.today().isoformat()
+    buf = out if out is not None else io.StringIO()
+    buf.write(f"## [{to_ref}] - {today}\n")
+    tmpl_scope = "- **%s**: %s (%s)\n"
+    tmpl_plain = "- %s (%s)\n"
+
+    for cat, bucket in zip(CATEGORY_ORDER, grouped):
+        if bucket:
+            buf.write(f"\n### {cat}\n\n")
+            buf.writelines(
+                tmpl_scope % (c["scope"], c["description"], c["hash"])
+                if c["scope"]
+                else tmpl_plain % (c["description"], c["hash"])
+                for c in bucket
+            )
 
-    for cat in CATEGORY_ORDER:
-        if cat in grouped:
-            lines.append(f"### {cat}\n")
-            for c in grouped[cat]:
-                scope = f"**{c['scope']}:** " if c["scope"] else ""
-                lines.append(f"* {scope}{c['description']} ([{c['hash']}])")
-            lines.append("")
+    if out is None:
+        return buf.getvalue()
+
+
+def format_conventional(commits, from_ref, to_ref, grouped=None, today=None, out=None):
+    if grouped is None:
+        grouped = group_commits(commits)
+    today = today or date.today().isoformat()
+    buf = out if out is not None else io.StringIO()
+    buf.write(f"# {to_ref} ({today})\n")
+    tmpl_scope = "* **%s:** %s ([%s])\n"
+    tmpl_plain = "* %s ([%s])\n"
+
+    for cat, bucket in zip(CATEGORY_ORDER, grouped):
+        if bucket:
+            buf.write(f"\n### {cat}\n\n")
+            buf.writelines(
+                tmpl_scope % (c["scope"], c["description"], c["hash"])
+                if c["scope"]
+                else tmpl_plain % (c["description"], c["hash"])
+                for c in bucket
+            )
 
-    return "\n".join(lines)
+    if out is None:
+        return buf.getvalue()
 
 
-def format_grouped(commits, from_ref, to_ref):
+def format_grouped(commits, from_ref, to_ref, grouped=None, today=None, out=None):
+    # git log emits newest commits first, so dates normally arrive already in
+    # descending order and the dict's insertion order can be used as-is. Author
+    # dates can still interleave after rebases; only then is a sort needed.
     by_date = defaultdict(list)
+    in_order = True
+    last = None
     for c in commits:
-        by_date[c["date"]].append(c)
-
-    lines = [f"# Changes: {from_ref} -> {to_ref}\n"]
-    for date in sorted(by_date.keys(), reverse=True):
-        lines.append(f"## {date}\n")
-        for c in by_date[date]:
-            lines.append(f"- {c['subject']} ({c['hash']}, {c['author']})")
-        lines.append("")
+        day = c["date"]
+        if day not in by_date:
+            if last is not None and day > last:
+                in_order = False
+            last = day
+        by_date[day].append(c)
+
+    buf = out if out is not None else io.StringIO()
+    buf.write(f"# Changes: {from_ref} -> {to_ref}\n")
+    tmpl = "- %s (%s, %s)\n"
+    dates = by_date if in_order else sorted(by_date, reverse=True)
+    for day in dates:
+        buf.write(f"\n## {day}\n\n")
+        buf.writelines(
+            tmpl % (c["subject"], c["hash"], c["author"]) for c in by_date[day]
+        )
 
-    return "\n".join(lines)
+    if out is None:
+        return buf.getvalue()
 
 
 FORMATTERS = {
@@ -179,26 +337,42 @@ FORMATTERS = {
 def prepend_to_file(filepath, new_content):
     """Insert new changelog entries below the first H1 header, above existing entries."""
     if not os.path.exists(filepath):
-        with open(filepath, "w") as f:
+        with open(filepath, "w", encoding="utf-8") as f:
             f.write(f"# Changelog\n\n{new_content}\n")
         return
 
-    with open(filepath, "r") as f:
-        existing = f.read()
-
-    h1_match = re.search(r"^# .+\n", existing)
-    if h1_match:
-        insert_pos = h1_match.end()
-        while insert_pos < len(existing) and existing[insert_pos] == "\n":
-            insert_pos += 1
-        updated = (
-            existing[:insert_pos] + "\n" + new_content + "\n\n" + existing[insert_pos:]
-        )
-    else:
-        updated = new_content + "\n\n" + existing
-
-    with open(filepath, "w") as f:
-        f.write(updated)
+    # Stream the old file into a temp copy so large changelogs are never held
+    # in memory; only a small prefix is read to locate the H1 header. Resolve
+    # symlinks so os.replace swaps the target rather than the link.
+    filepath = os.path.realpath(filepath)
+    tmp_path = filepath + ".tmp"
+    try:
+        with open(filepath, "rb") as src, open(tmp_path, "wb") as dst:
+            head = src.read(4096)
+            h1_match = _H1_RE.search(head)
+            entry = new_content.encode("utf-8") + b"\n\n"
+            if h1_match:
+                insert_pos = h1_match.end()
+                # Skip blank lines after the H1, reading past the prefix if needed.
+                while True:
+                    while insert_pos < len(head) and head[insert_pos] == ord("\n"):
+                        insert_pos += 1
+                    if insert_pos < len(head):
+                        break
+                    more = src.read(4096)
+                    if not more:
+                        break
+                    head += more
+                dst.write(head[:insert_pos] + b"\n" + entry + head[insert_pos:])
+            else:
+                dst.write(entry + head)
+            shutil.copyfileobj(src, dst, length=1 << 20)
+        shutil.copymode(filepath, tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
 
 def main():
@@ -209,13 +383,30 @@ def main():
     parser.add_argument(
         "--to", dest="to_ref", default="HEAD", help="End ref (default: HEAD)"
     )
-    parser.add_argument("--format", choices=FORMATTERS.keys(), default="keepachangelog")
+    parser.add_argument(
+        "--format",
+        default="keepachangelog",
+        help=f"Comma-separated output formats ({', '.join(FORMATTERS)})",
+    )
     parser.add_argument("--output", help="Output file path")
+    for name in FORMATTERS:
+        parser.add_argument(
+            f"--output-{name}",
+            dest=f"output_{name}",
+            metavar="FILE",
+            help=f"Output file path for the {name} format",
+        )
     parser.add_argument(
         "--version",
         dest="version_label",
         help="Version label for the changelog header (e.g. v1.3.0)",
     )
+    parser.add_argument(
+        "--date",
+        dest="release_date",
+        type=date.fromisoformat,
+        help="Release date for the changelog header, YYYY-MM-DD (default: today)",
+    )
     parser.add_argument(
         "--prepend",
         action="store_true",
@@ -231,9 +422,29 @@ def main():
     )
     args = parser.parse_args()
 
-    if args.prepend and not args.output:
+    formats = [f.strip() for f in args.format.split(",") if f.strip()]
+    formats = list(dict.fromkeys(formats))
+    unknown = [f for f in formats if f not in FORMATTERS]
+    if unknown or not formats:
+        parser.error(f"invalid --format: {args.format!r}")
+
+    if args.output and len(formats) > 1:
+        print(
+            "Error: --output takes a single format; use --output-<format>.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    stray = [f for f in FORMATTERS if getattr(args, f"output_{f}") and f not in formats]
+    if stray:
+        parser.error(f"--output-{stray[0]} given but {stray[0]!r} is not in --format")
+    outputs = {f: getattr(args, f"output_{f}") or args.output for f in formats}
+
+    if args.prepend and not any(outputs.values()):
         print("Error: --prepend requires --output.", file=sys.stderr)
         sys.exit(1)
+    missing = [f for f, path in outputs.items() if not path]
+    if args.prepend and missing:
+        parser.error(f"--prepend needs an output file for every format: {missing[0]}")
 
     from_ref = args.from_ref
     if not from_ref:
@@ -245,21 +456,25 @@ def main():
                 sys.exit(1)
             print(f"No tags found, using first commit: {from_ref[:8]}", file=sys.stderr)
 
-    commits = get_commits(from_ref, args.to_ref, args.no_merges)
-    if not commits:
+    excluded = None
+    if args.exclude_types:
+        excluded = frozenset(t.strip() for t in args.exclude_types.split(",")) - {""}
+
+    total = 0
+    commits = []
+    for c in iter_commits(from_ref, args.to_ref, args.no_merges):
+        total += 1
+        conv = _classify(c["subject"], c["body"])
+        m = conv[0]
+        if excluded and m and m.group("type") in excluded:
+            continue
+        c["_conv"] = conv
+        commits.append(c)
+
+    if not total:
         print("No commits found in range.", file=sys.stderr)
         sys.exit(0)
 
-    if args.exclude_types:
-        excluded = {t.strip() for t in args.exclude_types.split(",")}
-        filtered = []
-        for c in commits:
-            m = CONV_PATTERN.match(c["subject"])
-            if m and m.group("type") in excluded:
-                continue
-            filtered.append(c)
-        commits = filtered
-
     if not commits:
         print("No commits remaining after filtering.", file=sys.stderr)
         sys.exit(0)
@@ -269,20 +484,25 @@ def main():
         file=sys.stderr,
     )
 
-    formatter = FORMATTERS[args.format]
     label = args.version_label or args.to_ref
-    output = formatter(commits, from_ref, label)
-
-    if args.output:
-        if args.prepend:
-            prepend_to_file(args.output, output)
-            print(f"Changelog prepended to {args.output}", file=sys.stderr)
+    today = args.release_date.isoformat() if args.release_date else None
+    # Categorise once and share the buckets across every requested format.
+    grouped = group_commits(commits)
+    for fmt in formats:
+        formatter = FORMATTERS[fmt]
+        path = outputs[fmt]
+        if path and args.prepend:
+            output = formatter(commits, from_ref, label, grouped, today)
+            prepend_to_file(path, output)
+            print(f"Changelog prepended to {path}", file=sys.stderr)
+        elif path:
+            # Stream entries straight to disk rather than building the text first.
+            with open(path, "w") as f:
+                formatter(commits, from_ref, label, grouped, today, out=f)
+            print(f"Changelog written to {path}", file=sys.stderr)
         else:
-            with open(args.output, "w") as f:
-                f.write(output)
-            print(f"Changelog written to {args.output}", file=sys.stderr)
-    else:
-        print(output)
+            formatter(commits, from_ref, label, grouped, today, out=sys.stdout)
+            sys.stdout.write("\n")
 
 
 if __name__ == "__main__":